@@ -1,95 +1,405 @@
 import uvicorn
+import asyncio
 import random
 import os
-import json
 import jwt
+import orjson
 import hashlib
+import hmac
+import base64
+import sqlite3
+import threading
+import logging
+from cachetools import TTLCache
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime
-from typing import Optional, List, Dict, Any
-from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect, Query
+from urllib.parse import quote
+from typing import Optional, Dict, Set, Any
+from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect, Query, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
 
 SECRET_KEY = "squad-v39-visuals"
 ALGORITHM = "HS256"
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-DB_FILE = "squad_db_v18.json"
-
-def load_db():
-    if not os.path.exists(DB_FILE):
-        default_db = {"users": [], "hangouts": [], "dms": []}
-        with open(DB_FILE, 'w') as f:
-            json.dump(default_db, f)
-        return default_db
+logger = logging.getLogger(__name__)
+DB_FILE = "squad_v19.db"
+LEGACY_DB_FILE = "squad_db_v18.json"
+SEND_TIMEOUT = 1.0
+OUTBOX_SIZE = 64
+
+# --- DATABASE ---
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    hashed_password TEXT NOT NULL,
+    avatar_data TEXT,
+    bio TEXT NOT NULL DEFAULT '',
+    instagram TEXT NOT NULL DEFAULT '',
+    is_admin BOOLEAN NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS hangouts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT NOT NULL,
+    location TEXT NOT NULL,
+    event_time TEXT NOT NULL,
+    max_people INTEGER NOT NULL,
+    host_username TEXT NOT NULL,
+    image_data TEXT
+);
+CREATE TABLE IF NOT EXISTS attendees (
+    hangout_id INTEGER NOT NULL REFERENCES hangouts(id) ON DELETE CASCADE,
+    username TEXT NOT NULL,
+    avatar TEXT,
+    is_admin BOOLEAN NOT NULL DEFAULT 0,
+    PRIMARY KEY (hangout_id, username)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    hangout_id INTEGER NOT NULL REFERENCES hangouts(id) ON DELETE CASCADE,
+    user TEXT NOT NULL,
+    avatar TEXT,
+    text TEXT NOT NULL,
+    image TEXT,
+    is_admin BOOLEAN NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_attendees_username ON attendees (username);
+CREATE INDEX IF NOT EXISTS ix_messages_hangout_id ON messages (hangout_id);
+CREATE TABLE IF NOT EXISTS dms (
+    id INTEGER PRIMARY KEY,
+    sender TEXT NOT NULL,
+    receiver TEXT NOT NULL,
+    text TEXT NOT NULL,
+    image TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_dms_sender_receiver ON dms (sender, receiver);
+CREATE INDEX IF NOT EXISTS ix_dms_receiver_sender ON dms (receiver, sender);
+CREATE TABLE IF NOT EXISTS feed_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    epoch TEXT NOT NULL,
+    version INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO feed_version VALUES (1, lower(hex(randomblob(4))), 0);
+"""
+sqlite3.register_converter("BOOLEAN", lambda v: v == b"1")
+
+def dict_row(cursor, row): return {col[0]: value for col, value in zip(cursor.description, row)}
+
+# One connection per thread: WAL lets readers in the threadpool run while another thread writes
+local = threading.local()
+def get_conn():
+    conn = getattr(local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.row_factory = dict_row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA mmap_size=268435456")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.execute("PRAGMA busy_timeout=5000")
+        local.conn = conn
+    return conn
+
+@contextmanager
+def transaction():
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except:
+        # A failed COMMIT can leave the transaction open, which would wedge this thread's connection
+        if conn.in_transaction: conn.execute("ROLLBACK")
+        raise
+
+def init_db():
+    conn = get_conn()
+    conn.executescript(SCHEMA)
+    if os.path.exists(LEGACY_DB_FILE): import_legacy_db()
+    migrate_media()
+
+def import_legacy_db():
+    # One-time copy of the old JSON store into SQLite
     try:
-        with open(DB_FILE, 'r') as f:
-            return json.load(f)
+        with open(LEGACY_DB_FILE, 'rb') as f:
+            db = orjson.loads(f.read())
     except:
-        return {"users": [], "hangouts": [], "dms": []}
+        return
+    migrate_avatars(db)
+    with transaction() as conn:
+        # Checked under the write lock so concurrently starting workers import exactly once
+        if conn.execute("SELECT 1 FROM users LIMIT 1").fetchone(): return
+        conn.executemany("INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?, ?, ?)", [(u["username"], u["hashed_password"], u.get("avatar_data"), u.get("bio", ""), u.get("instagram", ""), u.get("is_admin", False)) for u in db["users"]])
+        # The JSON store numbered hangouts by list length, so ids repeat after a delete; repeats get fresh ids
+        seen, repeats = set(), []
+        for h in db["hangouts"]:
+            if h["id"] in seen: repeats.append(h); continue
+            seen.add(h["id"])
+            import_hangout(conn, h, h["id"])
+        for h in repeats: import_hangout(conn, h, None)
+        conn.executemany("INSERT INTO dms (sender, receiver, text, image, timestamp) VALUES (?, ?, ?, ?, ?)", [(m["sender"], m["receiver"], m.get("text", ""), m.get("image"), m.get("timestamp", "")) for m in db["dms"]])
+
+def import_hangout(conn, h, id):
+    id = conn.execute("INSERT INTO hangouts VALUES (?, ?, ?, ?, ?, ?, ?)", (id, h["title"], h["location"], h.get("event_time", "Now"), h.get("max_people", 5), h["host_username"], h.get("image_data"))).lastrowid
+    conn.executemany("INSERT OR IGNORE INTO attendees VALUES (?, ?, ?, ?)", [(id, a["username"], a.get("avatar"), a.get("is_admin", False)) for a in h["attendees"]])
+    conn.executemany("INSERT INTO messages (hangout_id, user, avatar, text, image, is_admin) VALUES (?, ?, ?, ?, ?, ?)", [(id, m["user"], m.get("avatar"), m.get("text", ""), m.get("image"), m.get("is_admin", False)) for m in h["messages"]])
+
+# --- MEDIA ---
+# Only raster images are accepted; anything else stored by a client could run as a page on this origin
+IMAGE_TYPES = {"image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif", "image/webp": ".webp"}
+
+# Every uploaded image (avatars, covers, chat and DM pictures) is written once under its content hash;
+# the avatar_data/image_data/image columns hold the resulting immutable URL
+MEDIA_DIR = "static/media"
+MEDIA_URL = "/static/media/"
+def store_media(data):
+    # Raises ValueError for anything but a well-formed raster image data URL
+    if not data: return None
+    header, _, body = data.partition(",")
+    ext = IMAGE_TYPES.get(header[5:-7]) if header.startswith("data:") and header.endswith(";base64") else None
+    if not ext: raise ValueError("unsupported image")
+    raw = base64.b64decode(body, validate=True)
+    name = hashlib.sha256(raw).hexdigest() + ext
+    path = os.path.join(MEDIA_DIR, name)
+    if not os.path.exists(path):
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        with open(tmp, "wb") as f: f.write(raw)
+        os.replace(tmp, path)
+    return MEDIA_URL + name
+
+class MediaFiles(StaticFiles):
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        return response
 
-def save_db(data):
-    with open(DB_FILE, 'w') as f:
-        json.dump(data, f)
+# Older tokens and rows point at /avatar/<name> and /hangout_image/<id>; those routes now just redirect
+def legacy_avatar_url(username): return f"/avatar/{quote(username, safe='')}"
 
-app = FastAPI()
-if not os.path.exists("static"):
-    os.makedirs("static")
+def media_redirect(url):
+    if not (url or "").startswith(MEDIA_URL): raise HTTPException(404)
+    return RedirectResponse(url)
+
+def migrate_avatars(db):
+    for h in db["hangouts"]:
+        for entry in h["attendees"] + h["messages"]:
+            if (entry.get("avatar") or "").startswith("data:"):
+                entry["avatar"] = legacy_avatar_url(entry.get("username", entry.get("user")))
+
+def migrate_media():
+    # Stores from before media files kept images as data URLs in their rows; move them out once
+    def stored(data):
+        try: return store_media(data)
+        except ValueError: return None
+    with transaction() as conn:
+        if conn.execute("PRAGMA user_version").fetchone()["user_version"]: return
+        avatars = {}
+        for user in conn.execute("SELECT username, avatar_data FROM users WHERE avatar_data LIKE 'data:%'").fetchall():
+            avatars[legacy_avatar_url(user["username"])] = url = stored(user["avatar_data"])
+            conn.execute("UPDATE users SET avatar_data = ? WHERE username = ?", (url, user["username"]))
+        for table in ("attendees", "messages"):
+            for row in conn.execute(f"SELECT rowid AS rid, avatar FROM {table} WHERE avatar LIKE '/avatar/%'").fetchall():
+                if row["avatar"] in avatars: conn.execute(f"UPDATE {table} SET avatar = ? WHERE rowid = ?", (avatars[row["avatar"]], row["rid"]))
+        for table, column in (("hangouts", "image_data"), ("messages", "image"), ("dms", "image")):
+            for row in conn.execute(f"SELECT rowid AS rid, {column} AS data FROM {table} WHERE {column} LIKE 'data:%'").fetchall():
+                conn.execute(f"UPDATE {table} SET {column} = ? WHERE rowid = ?", (stored(row["data"]), row["rid"]))
+        bump_feed(conn)
+        conn.execute("PRAGMA user_version = 1")
+
+# --- CHAT PERSISTENCE ---
+# Websocket chat messages are broadcast first and written here in batches, one transaction per batch
+message_queue: asyncio.Queue = asyncio.Queue()
+MESSAGE_BATCH_SIZE = 32
+MESSAGE_FLUSH_INTERVAL = 0.2
+MESSAGE_SAVE_ATTEMPTS = 5
+MESSAGE_RETRY_DELAY = 1.0
+
+def save_messages(batch):
+    with transaction() as conn:
+        # Messages for a hangout deleted in the meantime are dropped
+        conn.executemany("INSERT INTO messages (hangout_id, user, avatar, text, image, is_admin) SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM hangouts WHERE id = ?)", [(hangout_id, m["user"], m["avatar"], m["text"], m["image"], m["is_admin"], hangout_id) for hangout_id, m in batch])
+
+def drain_messages():
+    batch = []
+    while not message_queue.empty() and len(batch) < MESSAGE_BATCH_SIZE:
+        batch.append(message_queue.get_nowait())
+    return batch
+
+async def persist_messages():
+    loop = asyncio.get_running_loop()
+    batch, attempts = [], 0
+    while True:
+        try:
+            if batch: await asyncio.sleep(MESSAGE_RETRY_DELAY)
+            else:
+                # Hold the first message for up to MESSAGE_FLUSH_INTERVAL so a burst shares one commit
+                batch = [await message_queue.get()]
+                deadline = loop.time() + MESSAGE_FLUSH_INTERVAL
+                while len(batch) < MESSAGE_BATCH_SIZE:
+                    try: batch.append(await asyncio.wait_for(message_queue.get(), deadline - loop.time()))
+                    except asyncio.TimeoutError: break
+        except asyncio.CancelledError:
+            if batch: save_messages(batch)
+            raise
+        # Shielded so shutdown waits for an in-flight batch instead of racing it
+        save = asyncio.ensure_future(asyncio.to_thread(save_messages, batch))
+        try: await asyncio.shield(save)
+        except asyncio.CancelledError:
+            await asyncio.wait([save])
+            if save.exception(): save_messages(batch)
+            raise
+        except Exception:
+            attempts += 1
+            logger.exception("Saving %d chat messages failed (attempt %d)", len(batch), attempts)
+            if attempts < MESSAGE_SAVE_ATTEMPTS: continue
+            logger.error("Dropping %d chat messages", len(batch))
+        batch, attempts = [], 0
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Create the store before uvicorn accepts traffic instead of racing on the first requests
+    init_db()
+    load_index()
+    writer = asyncio.create_task(persist_messages())
+    yield
+    writer.cancel()
+    try: await writer
+    except asyncio.CancelledError: pass
+    except Exception: logger.exception("Saving chat messages on shutdown failed")
+    while not message_queue.empty():
+        save_messages(drain_messages())
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+def dumps_text(message: dict) -> str:
+    return orjson.dumps(message).decode()
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+os.makedirs(MEDIA_DIR, exist_ok=True)
+app.mount("/static/media", MediaFiles(directory=MEDIA_DIR), name="media")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # --- CONNECTION MANAGER ---
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[int, List[WebSocket]] = {}
-        self.user_connections: Dict[str, List[WebSocket]] = {}
+        self.active_connections: Dict[int, Set[WebSocket]] = {}
+        self.user_connections: Dict[str, Set[WebSocket]] = {}
+        # Every socket gets a bounded outbox drained by its own writer task, so a slow peer only delays itself
+        self.outboxes: Dict[WebSocket, asyncio.Queue] = {}
+        self.writers: Dict[WebSocket, asyncio.Task] = {}
+        self.closers: Set[asyncio.Task] = set()
+
+    def open_outbox(self, websocket: WebSocket):
+        self.outboxes[websocket] = asyncio.Queue(maxsize=OUTBOX_SIZE)
+        self.writers[websocket] = asyncio.create_task(self.writer(websocket, self.outboxes[websocket]))
+
+    def close_outbox(self, websocket: WebSocket):
+        self.outboxes.pop(websocket, None)
+        writer = self.writers.pop(websocket, None)
+        if writer and writer is not asyncio.current_task(): writer.cancel()
+
+    async def writer(self, websocket: WebSocket, outbox: asyncio.Queue):
+        while True:
+            text = await outbox.get()
+            try: await asyncio.wait_for(websocket.send_text(text), timeout=SEND_TIMEOUT)
+            except:
+                await self.kick(websocket)
+                return
+
+    async def kick(self, websocket: WebSocket):
+        # The handler's receive loop then fails and runs its normal disconnect
+        self.close_outbox(websocket)
+        await self.close(websocket)
+
+    async def close(self, websocket: WebSocket):
+        try: await websocket.close()
+        except: pass
+
+    def enqueue(self, websocket: WebSocket, text: str):
+        outbox = self.outboxes.get(websocket)
+        if outbox is None: return
+        try: outbox.put_nowait(text)
+        except asyncio.QueueFull:
+            # Drop the outbox now so later broadcasts skip this socket, and hold the close task until it finishes
+            self.close_outbox(websocket)
+            task = asyncio.create_task(self.close(websocket))
+            self.closers.add(task)
+            task.add_done_callback(self.closers.discard)
 
     async def connect(self, websocket: WebSocket, hangout_id: int):
         await websocket.accept()
-        if hangout_id not in self.active_connections:
-            self.active_connections[hangout_id] = []
-        self.active_connections[hangout_id].append(websocket)
+        self.open_outbox(websocket)
+        self.active_connections.setdefault(hangout_id, set()).add(websocket)
 
     def disconnect(self, websocket: WebSocket, hangout_id: int):
-        if hangout_id in self.active_connections:
-            if websocket in self.active_connections[hangout_id]:
-                self.active_connections[hangout_id].remove(websocket)
+        self.close_outbox(websocket)
+        room = self.active_connections.get(hangout_id)
+        if room is not None:
+            room.discard(websocket)
+            if not room: del self.active_connections[hangout_id]
 
-    async def broadcast(self, message: dict, hangout_id: int):
-        if hangout_id in self.active_connections:
-            for connection in self.active_connections[hangout_id][:]:
-                try: await connection.send_json(message)
-                except: pass
+    def broadcast(self, message: dict, hangout_id: int):
+        text = dumps_text(message)
+        for connection in self.active_connections.get(hangout_id, ()):
+            self.enqueue(connection, text)
 
     async def connect_user(self, websocket: WebSocket, username: str):
         await websocket.accept()
-        if username not in self.user_connections:
-            self.user_connections[username] = []
-        self.user_connections[username].append(websocket)
+        self.open_outbox(websocket)
+        self.user_connections.setdefault(username, set()).add(websocket)
 
     def disconnect_user(self, websocket: WebSocket, username: str):
-        if username in self.user_connections:
-            if websocket in self.user_connections[username]:
-                self.user_connections[username].remove(websocket)
-
-    async def send_to_user(self, username: str, message: dict):
-        if username in self.user_connections:
-            for connection in self.user_connections[username][:]:
-                try: await connection.send_json(message)
-                except:
-                    if connection in self.user_connections[username]:
-                        self.user_connections[username].remove(connection)
+        self.close_outbox(websocket)
+        sockets = self.user_connections.get(username)
+        if sockets is not None:
+            sockets.discard(websocket)
+            if not sockets: del self.user_connections[username]
+
+    def send_to_user(self, username: str, text: str):
+        for connection in self.user_connections.get(username, ()):
+            self.enqueue(connection, text)
 
 manager = ConnectionManager()
 
-def get_hash(p): return hashlib.sha256(p.encode()).hexdigest()
+# Passwords are stored as "scrypt$<salt>$<digest>"; bare hex digests are unsalted SHA-256 from older accounts
+SCRYPT_N = 2 ** 14
+def scrypt(p, salt): return hashlib.scrypt(p.encode(), salt=salt, n=SCRYPT_N, r=8, p=1)
+def hash_password(p):
+    salt = os.urandom(16)
+    return f"scrypt${salt.hex()}${scrypt(p, salt).hex()}"
+def needs_rehash(stored): return not stored.startswith("scrypt$")
+def verify_password(p, stored):
+    if needs_rehash(stored): return hmac.compare_digest(hashlib.sha256(p.encode()).digest(), bytes.fromhex(stored))
+    _, salt, digest = stored.split("$")
+    return hmac.compare_digest(scrypt(p, bytes.fromhex(salt)), bytes.fromhex(digest))
 def create_token(d): return jwt.encode(d, SECRET_KEY, algorithm=ALGORITHM)
+
+# The fields handlers need about the caller ride in the token, so authenticating doesn't touch the store
+def token_claims(user): return {"sub": user["username"], "adm": user["is_admin"], "av": user["avatar_data"]}
+def user_from_payload(payload):
+    if "adm" in payload: return {"username": payload["sub"], "is_admin": payload["adm"], "avatar": payload.get("av")}
+    # Tokens issued before the claims were added still need a lookup
+    return get_conn().execute("SELECT username, is_admin, avatar_data AS avatar FROM users WHERE username = ?", (payload.get("sub"),)).fetchone()
+
+# Resolved callers keyed by a digest of the token, so repeat requests skip both the HMAC check and any lookup
+token_cache = TTLCache(maxsize=50_000, ttl=60)
+def authenticate(token: str) -> Optional[dict]:
+    key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    user = token_cache.get(key)
+    if user is None:
+        user = user_from_payload(jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]))
+        if user: token_cache[key] = user
+    return user
+
 async def get_current_user(token: str = Depends(oauth2_scheme)):
-    try: 
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username = payload.get("sub")
-        db = load_db()
-        user = next((u for u in db["users"] if u["username"] == username), None)
+    try: user = authenticate(token)
     except: raise HTTPException(status_code=401)
     if not user: raise HTTPException(status_code=401)
     return user
@@ -99,80 +409,121 @@ def health(): return {"status": "ok", "version": "v39_visuals"}
 
 @app.post("/register")
 def register(u: dict):
-    db = load_db()
-    if any(user["username"] == u['username'] for user in db["users"]): raise HTTPException(400, "Taken")
-    new_user = { "username": u['username'], "hashed_password": get_hash(u['password']), "avatar_data": u.get('avatar_data'), "bio": "Just joined Squad!", "instagram": "", "is_admin": (u['username'].lower() == "qasim") }
-    db["users"].append(new_user)
-    save_db(db)
+    try: avatar = store_media(u.get('avatar_data'))
+    except ValueError: raise HTTPException(400, "Bad image")
+    try: get_conn().execute("INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)", (u['username'], hash_password(u['password']), avatar, "Just joined Squad!", "", u['username'].lower() == "qasim"))
+    except sqlite3.IntegrityError: raise HTTPException(400, "Taken")
     return {"msg": "ok"}
 
 @app.post("/token")
 def login(f: OAuth2PasswordRequestForm = Depends()):
-    db = load_db()
-    user = next((u for u in db["users"] if u["username"] == f.username), None)
-    if not user or user["hashed_password"] != get_hash(f.password): raise HTTPException(400, "Fail")
-    return {"access_token": create_token({"sub": user["username"]}), "token_type": "bearer", "username": user["username"], "avatar": user["avatar_data"], "is_admin": user.get("is_admin", False)}
+    user = get_conn().execute("SELECT * FROM users WHERE username = ?", (f.username,)).fetchone()
+    if not user or not verify_password(f.password, user["hashed_password"]): raise HTTPException(400, "Fail")
+    if needs_rehash(user["hashed_password"]):
+        get_conn().execute("UPDATE users SET hashed_password = ? WHERE username = ?", (hash_password(f.password), user["username"]))
+    return {"access_token": create_token(token_claims(user)), "token_type": "bearer", "username": user["username"], "avatar": user["avatar_data"], "is_admin": user["is_admin"]}
 
 class ProfileSchema(BaseModel): bio: str; instagram: str
 @app.post("/update_profile")
 def update_profile(p: ProfileSchema, u: dict = Depends(get_current_user)):
-    db = load_db()
-    for user in db["users"]:
-        if user["username"] == u["username"]:
-            user["bio"] = p.bio; user["instagram"] = p.instagram
-            save_db(db)
-            return {"msg": "updated"}
-    raise HTTPException(404)
+    cur = get_conn().execute("UPDATE users SET bio = ?, instagram = ? WHERE username = ?", (p.bio, p.instagram, u["username"]))
+    if not cur.rowcount: raise HTTPException(404)
+    return {"msg": "updated"}
 
 @app.get("/get_user/{username}")
 def get_user_profile(username: str):
-    db = load_db()
-    user = next((u for u in db["users"] if u["username"] == username), None)
+    user = get_conn().execute("SELECT username, avatar_data AS avatar, bio, instagram, is_admin FROM users WHERE username = ?", (username,)).fetchone()
     if not user: raise HTTPException(404)
-    return {"username": user["username"], "avatar": user["avatar_data"], "bio": user.get("bio", ""), "instagram": user.get("instagram", ""), "is_admin": user.get("is_admin", False)}
+    return user
+
+# Every write that changes the feed bumps the version in the same transaction, so all workers see it;
+# pages are memoized per process and revalidated by ETag until then
+feed_pages: Dict[tuple, tuple] = {}
+def bump_feed(conn): conn.execute("UPDATE feed_version SET version = version + 1")
 
 class HangoutSchema(BaseModel): title: str; location: str; event_time: str; max_people: int; image_data: Optional[str] = None
 @app.post("/create_hangout/")
 def create_h(h: HangoutSchema, u: dict = Depends(get_current_user)):
-    db = load_db()
-    new_id = len(db["hangouts"]) + 1
-    new_hangout = { "id": new_id, "title": h.title, "location": h.location, "event_time": h.event_time, "max_people": h.max_people, "host_username": u["username"], "image_data": h.image_data, "attendees": [{"username": u["username"], "avatar": u["avatar_data"], "is_admin": u.get("is_admin", False)}], "messages": [] }
-    db["hangouts"].append(new_hangout)
-    save_db(db)
+    try: image = store_media(h.image_data)
+    except ValueError: raise HTTPException(400, "Bad image")
+    with transaction() as conn:
+        new_id = conn.execute("INSERT INTO hangouts (title, location, event_time, max_people, host_username, image_data) VALUES (?, ?, ?, ?, ?, ?)", (h.title, h.location, h.event_time, h.max_people, u["username"], image)).lastrowid
+        conn.execute("INSERT INTO attendees VALUES (?, ?, ?, ?)", (new_id, u["username"], u["avatar"], u["is_admin"]))
+        bump_feed(conn)
     return {"msg": "ok"}
 
 @app.post("/join_hangout/{id}")
 def join_h(id: int, u: dict = Depends(get_current_user)):
-    db = load_db()
-    for h in db["hangouts"]:
-        if h["id"] == id:
-            if len(h["attendees"]) >= h["max_people"]: raise HTTPException(400, "Full")
-            if not any(a["username"] == u["username"] for a in h["attendees"]):
-                h["attendees"].append({"username": u["username"], "avatar": u["avatar_data"], "is_admin": u.get("is_admin", False)})
-                save_db(db)
-            break
+    with transaction() as conn:
+        h = conn.execute("SELECT max_people, (SELECT COUNT(*) FROM attendees WHERE hangout_id = hangouts.id) AS count FROM hangouts WHERE id = ?", (id,)).fetchone()
+        if h:
+            if h["count"] >= h["max_people"]: raise HTTPException(400, "Full")
+            if conn.execute("INSERT OR IGNORE INTO attendees VALUES (?, ?, ?, ?)", (id, u["username"], u["avatar"], u["is_admin"])).rowcount: bump_feed(conn)
     return {"msg": "ok"}
 
 @app.delete("/delete_hangout/{id}")
 def del_h(id: int, u: dict = Depends(get_current_user)):
-    db = load_db()
-    db["hangouts"] = [h for h in db["hangouts"] if not (h["id"] == id and (h["host_username"] == u["username"] or u.get("is_admin", False)))]
-    save_db(db)
+    with transaction() as conn:
+        if conn.execute("DELETE FROM hangouts WHERE id = ? AND (host_username = ? OR ?)", (id, u["username"], u["is_admin"])).rowcount: bump_feed(conn)
     return {"msg": "ok"}
 
+HANGOUT_COLUMNS = "id, title, location, event_time, max_people, host_username, image_data"
+
+def hangout_summary(h, attendees):
+    return { "id": h["id"], "title": h["title"], "location": h["location"], "event_time": h["event_time"], "max_people": h["max_people"], "host": h["host_username"], "image_url": h["image_data"], "attendees": attendees, "count": len(attendees), "is_full": len(attendees) >= h["max_people"] }
+
+def load_attendees(conn, hangout_ids):
+    # One query for the whole page rather than one per hangout
+    attendees = {hid: [] for hid in hangout_ids}
+    if hangout_ids:
+        for a in conn.execute(f"SELECT hangout_id, username, avatar, is_admin FROM attendees WHERE hangout_id IN ({','.join('?' * len(hangout_ids))}) ORDER BY rowid", hangout_ids):
+            attendees[a.pop("hangout_id")].append(a)
+    return attendees
+
 @app.get("/hangouts/")
-def feed(u: dict = Depends(get_current_user)):
-    db = load_db()
-    results = []
-    for h in db["hangouts"]:
-        results.append({ "id": h["id"], "title": h["title"], "location": h["location"], "event_time": h.get("event_time", "Now"), "max_people": h.get("max_people", 5), "host": h["host_username"], "image_data": h.get("image_data"), "attendees": h["attendees"], "count": len(h["attendees"]), "is_full": len(h["attendees"]) >= h.get("max_people", 5) })
-    return {"feed": results}
+def feed(request: Request, limit: int = Query(20, ge=1, le=100), before_id: Optional[int] = None, joined: bool = False, u: dict = Depends(get_current_user)):
+    # Read the version before the store so a concurrent write can only make the cached page newer than its tag
+    conn = get_conn()
+    version = conn.execute("SELECT epoch || '-' || version AS v FROM feed_version").fetchone()["v"]
+    member = u["username"] if joined else None
+    key = (limit, before_id, member)
+    headers = {"ETag": f'"{version}-{hashlib.blake2b(repr(key).encode(), digest_size=8).hexdigest()}"', "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == headers["ETag"]: return Response(status_code=304, headers=headers)
+    cached = feed_pages.get(key)
+    if cached and cached[0] == version: return Response(cached[1], media_type="application/json", headers=headers)
+    # Newest first, paged by id so hangouts created or deleted meanwhile don't shift later pages
+    where, params = [], []
+    if before_id is not None: where.append("id < ?"); params.append(before_id)
+    if member is not None: where.append("id IN (SELECT hangout_id FROM attendees WHERE username = ?)"); params.append(member)
+    page = conn.execute(f"SELECT {HANGOUT_COLUMNS} FROM hangouts {'WHERE ' + ' AND '.join(where) if where else ''} ORDER BY id DESC LIMIT ?", (*params, limit)).fetchall()
+    attendees = load_attendees(conn, [h["id"] for h in page])
+    next_before_id = page[-1]["id"] if len(page) == limit else None
+    body = orjson.dumps({"feed": [hangout_summary(h, attendees[h["id"]]) for h in page], "limit": limit, "next_before_id": next_before_id})
+    if len(feed_pages) >= 256: feed_pages.clear()
+    feed_pages[key] = (version, body)
+    return Response(body, media_type="application/json", headers=headers)
+
+@app.get("/hangouts/{id}")
+def hangout_detail(id: int, u: dict = Depends(get_current_user)):
+    conn = get_conn()
+    h = conn.execute(f"SELECT {HANGOUT_COLUMNS} FROM hangouts WHERE id = ?", (id,)).fetchone()
+    if not h: raise HTTPException(404)
+    return ORJSONResponse(hangout_summary(h, load_attendees(conn, [id])[id]))
+
+@app.get("/hangout_image/{id}")
+def hangout_image(id: int):
+    h = get_conn().execute("SELECT image_data FROM hangouts WHERE id = ?", (id,)).fetchone()
+    return media_redirect(h["image_data"] if h else None)
+
+@app.get("/avatar/{username:path}")
+def avatar(username: str):
+    user = get_conn().execute("SELECT avatar_data FROM users WHERE username = ?", (username,)).fetchone()
+    return media_redirect(user["avatar_data"] if user else None)
 
 @app.get("/chat_history/{hangout_id}")
 def chat_hist(hangout_id: int):
-    db = load_db()
-    h = next((h for h in db["hangouts"] if h["id"] == hangout_id), None)
-    return h["messages"] if h else []
+    msgs = get_conn().execute("SELECT user, avatar, text, image, is_admin FROM messages WHERE hangout_id = ? ORDER BY id", (hangout_id,)).fetchall()
+    return ORJSONResponse(msgs)
 
 # --- PRIVATE DM LOGIC (IMAGES ADDED) ---
 class DMSchema(BaseModel):
@@ -180,52 +531,44 @@ class DMSchema(BaseModel):
     text: str
     image: Optional[str] = None
 
+def save_dm(sender, dm):
+    image = store_media(dm.image)
+    get_conn().execute("INSERT INTO dms (sender, receiver, text, image, timestamp) VALUES (?, ?, ?, ?, ?)", (sender, dm.receiver, dm.text, image, datetime.now().strftime("%H:%M")))
+    return image
+
 @app.post("/send_dm")
 async def send_dm(dm: DMSchema, u: dict = Depends(get_current_user)):
-    db = load_db()
-    msg_obj = {
-        "sender": u["username"],
-        "receiver": dm.receiver,
-        "text": dm.text,
-        "image": dm.image,
-        "timestamp": datetime.now().strftime("%H:%M")
-    }
-    db["dms"].append(msg_obj)
-    save_db(db)
+    # Off the event loop: the insert can wait on the write lock while the chat writer commits
+    try: image = await asyncio.to_thread(save_dm, u["username"], dm)
+    except ValueError: raise HTTPException(400, "Bad image")
     
-    payload = {"type": "dm", "sender": u["username"], "text": dm.text, "image": dm.image}
-    await manager.send_to_user(dm.receiver, payload)
-    await manager.send_to_user(u["username"], payload)
+    # Encoded once for both the receiver's and the sender's sockets
+    payload = dumps_text({"type": "dm", "sender": u["username"], "text": dm.text, "image": image})
+    manager.send_to_user(dm.receiver, payload)
+    manager.send_to_user(u["username"], payload)
     
     return {"msg": "sent"}
 
 @app.get("/my_dms")
 def get_my_dms(u: dict = Depends(get_current_user)):
-    db = load_db()
-    my_msgs = [m for m in db["dms"] if m["sender"] == u["username"] or m["receiver"] == u["username"]]
-    partners = {}
-    for m in my_msgs:
-        p = m["receiver"] if m["sender"] == u["username"] else m["sender"]
-        partners[p] = m 
+    # The store picks each partner's latest DM and avatar; conversations stay in order of their first message
+    rows = get_conn().execute(f"SELECT latest.partner, dms.text, dms.image, users.avatar_data FROM (SELECT CASE WHEN sender = ? THEN receiver ELSE sender END AS partner, MIN(id) AS first_id, MAX(id) AS last_id FROM dms WHERE sender = ? OR receiver = ? GROUP BY partner) AS latest JOIN dms ON dms.id = latest.last_id LEFT JOIN users ON users.username = latest.partner ORDER BY latest.first_id", (u["username"],) * 3).fetchall()
     result = []
-    for p_name, last_msg in partners.items():
-        p_data = next((user for user in db["users"] if user["username"] == p_name), None)
-        avatar = p_data["avatar_data"] if p_data else None
-        preview = "📷 Image" if last_msg.get("image") and not last_msg["text"] else last_msg["text"]
-        result.append({"partner": p_name, "avatar": avatar, "last_msg": preview})
-    return result
+    for r in rows:
+        preview = "📷 Image" if r["image"] and not r["text"] else r["text"]
+        result.append({"partner": r["partner"], "avatar": r["avatar_data"], "last_msg": preview})
+    return ORJSONResponse(result)
 
 @app.get("/dm_history/{partner}")
 def dm_history(partner: str, u: dict = Depends(get_current_user)):
-    db = load_db()
-    msgs = [m for m in db["dms"] if (m["sender"] == u["username"] and m["receiver"] == partner) or (m["sender"] == partner and m["receiver"] == u["username"])]
-    return msgs
+    msgs = get_conn().execute("SELECT sender, receiver, text, image, timestamp FROM dms WHERE (sender = ? AND receiver = ?) OR (sender = ? AND receiver = ?) ORDER BY id", (u["username"], partner, partner, u["username"])).fetchall()
+    return ORJSONResponse(msgs)
 
 # --- WEBSOCKETS ---
 @app.websocket("/ws/me")
 async def ws_personal(websocket: WebSocket, token: str = Query(...)):
     try:
-        try: payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]); username = payload.get("sub")
+        try: username = authenticate(token)["username"]
         except: await websocket.close(); return
         await manager.connect_user(websocket, username)
         while True: await websocket.receive_text()
@@ -234,34 +577,52 @@ async def ws_personal(websocket: WebSocket, token: str = Query(...)):
 @app.websocket("/ws/{hangout_id}")
 async def ws_endpoint(websocket: WebSocket, hangout_id: int, token: str = Query(...)):
     try:
-        try: payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]); username = payload.get("sub")
+        try: user = authenticate(token)
         except: await websocket.close(); return
-        db = load_db()
-        user = next((u for u in db["users"] if u["username"] == username), None)
         if not user: await websocket.close(); return
+        username = user["username"]
         
         await manager.connect(websocket, hangout_id)
+        receive, broadcast = websocket.receive_text, manager.broadcast
+        user_avatar, is_admin = user["avatar"], user["is_admin"]
         while True:
-            raw = await websocket.receive_text()
-            data = json.loads(raw) # Expecting JSON now
+            data = orjson.loads(await receive()) # Expecting JSON now
             
             msg_text = data.get("text", "")
             msg_img = data.get("image", None)
-            is_admin = user.get("is_admin", False)
-            
-            db = load_db()
-            for h in db["hangouts"]:
-                if h["id"] == hangout_id:
-                    h["messages"].append({"user": username, "avatar": user["avatar_data"], "text": msg_text, "image": msg_img, "is_admin": is_admin})
-                    save_db(db)
-                    break
+            if msg_img:
+                # A rejected image is dropped with an error frame to the sender; any text still goes out
+                try: msg_img = await asyncio.to_thread(store_media, msg_img)
+                except ValueError:
+                    msg_img = None
+                    manager.enqueue(websocket, dumps_text({"type": "error", "detail": "Bad image"}))
+                    if not msg_text: continue
             
-            await manager.broadcast({"type": "msg", "user": username, "avatar": user["avatar_data"], "text": msg_text, "image": msg_img, "is_admin": is_admin}, hangout_id)
+            msg = {"user": username, "avatar": user_avatar, "text": msg_text, "image": msg_img, "is_admin": is_admin}
+            broadcast({"type": "msg", **msg}, hangout_id)
+            message_queue.put_nowait((hangout_id, msg))
     except: manager.disconnect(websocket, hangout_id)
 
+# index.html is read once at startup and revalidated by ETag
+INDEX_HTML = b""
+INDEX_ETAG = ""
+def load_index():
+    global INDEX_HTML, INDEX_ETAG
+    if not os.path.exists("static/index.html"): return
+    with open("static/index.html", "rb") as f:
+        INDEX_HTML = f.read()
+    INDEX_ETAG = f'"{hashlib.blake2b(INDEX_HTML, digest_size=16).hexdigest()}"'
+
 @app.get("/")
-def root(): return FileResponse("static/index.html")
+def root(request: Request):
+    if not INDEX_HTML: raise HTTPException(404)
+    headers = {"ETag": INDEX_ETAG, "Cache-Control": "public, max-age=60"}
+    if request.headers.get("if-none-match") == INDEX_ETAG: return Response(status_code=304, headers=headers)
+    return Response(INDEX_HTML, media_type="text/html", headers=headers)
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # loop/http stay on "auto", which picks uvloop and httptools wherever they are installed
+    # Websocket rooms live in this process, so stay on one worker unless WEB_CONCURRENCY says otherwise
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    uvicorn.run("main:app", host="0.0.0.0", port=port, workers=workers, log_level="warning", access_log=False)